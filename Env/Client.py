@@ -35,7 +35,8 @@ class Client:
             cfg (Config): Configuration object with various settings for the simulation.
         """
 
-        if cfg.enable_GUI:
+        self.enable_GUI = cfg.enable_GUI
+        if self.enable_GUI:
             if cfg.enable_capture:
                 width, height = cfg.width, cfg.height
                 self.client_id = p.connect(
@@ -119,6 +120,34 @@ class Client:
         """
         time.sleep(x)
 
+    def step_for(self, x):  # seconds
+        """
+        Advance the simulation by a given number of seconds of simulated time.
+
+        Unlike `run`, steps are issued back to back without real-time pacing,
+        which is much faster when no GUI is attached.
+
+        Args:
+            x (float): Number of simulated seconds to advance.
+        """
+        for _ in range(int(x / self.timestep)):
+            p.stepSimulation(physicsClientId=self.client_id)
+            if self.blender:
+                self.recorder.add_keyframe()
+
+    def run_schedule(self, schedule, real_time=False):
+        """
+        Execute a sequence of actions, each followed by a pause.
+
+        Args:
+            schedule (list): A list of (action, seconds) pairs, where action is a callable taking no arguments.
+            real_time (bool): If True, pause with `wait`, otherwise advance simulated time with `step_for`.
+        """
+        pause = self.wait if real_time else self.step_for
+        for action, seconds in schedule:
+            action()
+            pause(seconds)
+
     def run(self, x=1):  # steps
         """
         Step the simulation for a given number of steps.
@@ -254,6 +283,39 @@ class Client:
 
         self.run(10)
 
+    def change_object_joint_angles(self, joint_targets, max_force=5, steps=10):
+        """
+        Change the state of several object joints at once.
+
+        The targets are grouped per object and sent with one motor command per
+        object, then the simulation is stepped once for all of them.
+
+        Args:
+            joint_targets (list): (object, joint_index, target_position) tuples, where
+                object is the ID or name of the object.
+            max_force (float): The maximum force to be applied to achieve each target position.
+            steps (int): Number of simulation steps to run after sending the commands.
+        """
+        grouped_targets = {}
+        for object, joint_index, target_position in joint_targets:
+            joint_indices, target_positions = grouped_targets.setdefault(
+                self.resolve_object_id(object), ([], [])
+            )
+            joint_indices.append(joint_index)
+            target_positions.append(target_position)
+
+        for object_id, (joint_indices, target_positions) in grouped_targets.items():
+            p.setJointMotorControlArray(
+                bodyUniqueId=object_id,
+                jointIndices=joint_indices,
+                controlMode=p.POSITION_CONTROL,
+                targetPositions=target_positions,
+                forces=[max_force] * len(joint_indices),
+                physicsClientId=self.client_id,
+            )
+
+        self.run(steps)
+
     # ----------------------------------------------------------------
     # Get info from environment
     # ----------------------------------------------------------------
@@ -450,4 +512,4 @@ class Client:
         Save the current pybullet-blender recording to a file with a timestamped name.
         """
         current_time = datetime.now().strftime("%Y%m%d_%H%M%S")
-        self.recorder.save(f"../Examples/record/{current_time}.pkl")
+        self.recorder.save(f"../Examples/record/{current_time}.npz")
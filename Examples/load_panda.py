@@ -10,18 +10,23 @@
 
 
 import os
+from pathlib import Path
 
 from Env.Client import Client
 from RoboticsToolBox.Bestman_sim_panda import Bestman_sim_panda
 from config.load_config import load_config
 from Visualization.Visualizer import Visualizer
 
+# config path resolved once, independent of the current working directory
+CONFIG_PATH = str(
+    (Path(__file__).resolve().parent / "../Config/load_panda.yaml").resolve()
+)
 
-def main(filename):
+
+def main(filename, cfg_path=CONFIG_PATH):
 
     # load config
-    config_path = "../Config/load_panda.yaml"
-    cfg = load_config(config_path)
+    cfg = load_config(cfg_path)
     print(cfg)
 
     # Init client and visualizer
@@ -35,26 +40,29 @@ def main(filename):
     panda = Bestman_sim_panda(client, visualizer, cfg)
     visualizer.change_robot_color(panda.sim_get_base_id(), panda.sim_get_arm_id(), False)
 
-    for _ in range(5):
-        panda.sim_open_gripper()
-        client.wait(2)
-        panda.sim_close_gripper()
-        client.wait(2)
+    # Real-time pacing only matters when a GUI is attached
+    real_time = cfg.Client.enable_GUI
+
+    schedule = [(panda.sim_open_gripper, 2), (panda.sim_close_gripper, 2)] * 5
+    client.run_schedule(schedule, real_time=real_time)
 
     # End record
     visualizer.end_record()
 
     # disconnect pybullet
-    client.wait(5)
+    if real_time:
+        client.wait(5)
+    else:
+        client.step_for(5)
     client.disconnect()
 
 
 if __name__ == "__main__":
 
-    # set work dir to Examples
+    # set work dir to Examples, asset / log / record paths are relative to it
     os.chdir(os.path.dirname(os.path.abspath(__file__)))
 
     # get current file name
-    file_name = os.path.splitext(os.path.basename(__file__))[0]
+    file_name = Path(__file__).stem
 
     main(file_name)
@@ -20,6 +20,75 @@ from Visualization import Camera
 from .Pose import Pose
 
 
+def _yaw_quat(yaw):
+    half = 0.5 * yaw
+    return (0.0, 0.0, math.sin(half), math.cos(half))
+
+
+def _shortest_angular_distance(from_angle, to_angle):
+    return (to_angle - from_angle + math.pi) % (2 * math.pi) - math.pi
+
+
+def _plan_yaw_steps(current_yaw, target_yaw, step_size):
+    """
+    Plan the intermediate yaw angles for a gradual base rotation.
+
+    Args:
+        current_yaw (float): The current yaw angle (in radians).
+        target_yaw (float): The target yaw angle (in radians).
+        step_size (float): Angle increment for each step in radians.
+
+    Returns:
+        tuple: An (N,) array of wrapped yaw angles and an (N, 4) array of the matching quaternions.
+    """
+    angle_diff = _shortest_angular_distance(current_yaw, target_yaw)
+    num_steps = max(math.ceil(abs(angle_diff) / step_size) - 1, 0)
+
+    yaws = current_yaw + math.copysign(step_size, angle_diff) * np.arange(
+        1, num_steps + 1
+    )
+    yaws = (yaws + np.pi) % (2 * np.pi) - np.pi
+
+    quaternions = np.zeros((num_steps, 4))
+    quaternions[:, 2] = np.sin(yaws / 2.0)
+    quaternions[:, 3] = np.cos(yaws / 2.0)
+    return yaws, quaternions
+
+
+def _interpolate_poses(start_pose, goal_pose, steps):
+    """
+    Interpolate between two poses, linearly for position and with slerp for orientation.
+
+    Args:
+        start_pose (Pose): The start pose.
+        goal_pose (Pose): The goal pose.
+        steps (int): Number of interpolated poses, including both ends.
+
+    Returns:
+        tuple: An (steps, 3) array of positions and an (steps, 4) array of quaternions.
+    """
+    t = np.linspace(0, 1, steps)[:, None]
+
+    p0 = np.asarray(start_pose.get_position(), dtype=np.float64)
+    p1 = np.asarray(goal_pose.get_position(), dtype=np.float64)
+    positions = (1 - t) * p0 + t * p1
+
+    q0 = np.asarray(start_pose.get_orientation(), dtype=np.float64)
+    q1 = np.asarray(goal_pose.get_orientation(), dtype=np.float64)
+    dot = np.dot(q0, q1)
+    if dot < 0:  # take the shortest path
+        q1, dot = -q1, -dot
+    theta = np.arccos(min(dot, 1.0))
+    if theta < 1e-6:  # nearly identical orientations, fall back to lerp
+        w0, w1 = 1 - t, t
+    else:
+        w0 = np.sin((1 - t) * theta) / np.sin(theta)
+        w1 = np.sin(t * theta) / np.sin(theta)
+    orientations = w0 * q0 + w1 * q1
+    orientations /= np.linalg.norm(orientations, axis=1, keepdims=True)
+    return positions, orientations
+
+
 class Bestman_sim:
     """A basic class for BestMan robot
 
@@ -98,16 +167,28 @@ class Bestman_sim:
             fixed_base=True,
         )
         self.arm_joints_idx = robot_cfg.arm_joints_idx
+        self._arm_all_joint_idx = tuple(
+            range(p.getNumJoints(self.arm_id, physicsClientId=self.client_id))
+        )  # the joint count of a loaded body never changes
         self.DOF = len(self.arm_joints_idx)
         self.arm_place_height = robot_cfg.base_height + 0.02
         self.end_effector_index = robot_cfg.end_effector_index
         self.tcp_link = robot_cfg.tcp_link
         self.tcp_height = robot_cfg.tcp_height
-        self.arm_reset_jointValues = robot_cfg.arm_reset_jointValues  # arm reset joint values
+        self._ee_pose_buf = Pose([0, 0, 0], [0, 0, 0, 1])  # reused by the fast EE query
+        self.arm_reset_jointValues = tuple(robot_cfg.arm_reset_jointValues)
         self.arm_jointInfo = self.sim_get_arm_all_jointInfo()
-        self.arm_lower_limits = [info.lowerLimit for info in self.arm_jointInfo]
-        self.arm_upper_limits = [info.upperLimit for info in self.arm_jointInfo]
-        self.arm_joint_ranges = [info.upperLimit - info.lowerLimit for info in self.arm_jointInfo]
+        # one pass over the joint infos, one contiguous row per field
+        joint_rows = [
+            (info.lowerLimit, info.upperLimit, info.maxForce, info.maxVelocity)
+            for info in self.arm_jointInfo
+        ]
+        joint_fields = np.array(joint_rows, dtype=np.float64).reshape(-1, 4).T.copy()
+        self.arm_lower_limits = joint_fields[0]
+        self.arm_upper_limits = joint_fields[1]
+        self.arm_max_forces = joint_fields[2]
+        self.arm_max_velocities = joint_fields[3]
+        self.arm_joint_ranges = self.arm_upper_limits - self.arm_lower_limits
 
         # Add constraint between base and arm
         p.createConstraint(
@@ -137,6 +218,7 @@ class Bestman_sim:
         
         # global parameters
         self.constraint_id = None  # grasp constraint id
+        self._last_joint_solution = None  # full IK solution of the last solve
 
     # ----------------------------------------------------------------
     # functions for base
@@ -188,58 +270,31 @@ class Bestman_sim:
             delay_time (float, optional): Delay in seconds after each step. Only used if gradual=True.
         """
 
-        def angle_to_quaternion(yaw):
-            return [0, 0, math.sin(yaw / 2.0), math.cos(yaw / 2.0)]
-
-        def shortest_angular_distance(from_angle, to_angle):
-            return (to_angle - from_angle + math.pi) % (2 * math.pi) - math.pi
+        # The base is fixed and rotating does not move it, so read its position once
+        position, _ = p.getBasePositionAndOrientation(
+            self.base_id, physicsClientId=self.client_id
+        )
 
         if gradual:
 
-            angle_diff = shortest_angular_distance(self.current_base_yaw, target_yaw)
-
-            while abs(angle_diff) > step_size:
-
-                if angle_diff > 0:
-                    self.current_base_yaw += step_size
-                else:
-                    self.current_base_yaw -= step_size
+            yaws, orientations = _plan_yaw_steps(
+                self.current_base_yaw, target_yaw, step_size
+            )
 
-                self.current_base_yaw = (self.current_base_yaw + math.pi) % (
-                    2 * math.pi
-                ) - math.pi
-                angle_diff = shortest_angular_distance(self.current_base_yaw, target_yaw)
-                orientation = angle_to_quaternion(self.current_base_yaw)
-                position, _ = p.getBasePositionAndOrientation(
-                    self.base_id, physicsClientId=self.client_id
-                )
-                p.resetBasePositionAndOrientation(
-                    self.base_id, position, orientation, physicsClientId=self.client_id
-                )
-                self.sim_sync_base_arm_pose()
+            for yaw, orientation in zip(yaws, orientations):
+                self.current_base_yaw = float(yaw)
+                self._reset_base_and_arm(position, orientation)
                 self.client.run()
 
             # Ensure final orientation is set accurately
-            orientation = angle_to_quaternion(target_yaw)
-            position, _ = p.getBasePositionAndOrientation(
-                self.base_id, physicsClientId=self.client_id
-            )
-            p.resetBasePositionAndOrientation(
-                self.base_id, position, orientation, physicsClientId=self.client_id
-            )
-            self.sim_sync_base_arm_pose()
+            orientation = _yaw_quat(target_yaw)
+            self._reset_base_and_arm(position, orientation)
             self.current_base_yaw = target_yaw
             self.client.run()
 
         else:
-            orientation = angle_to_quaternion(target_yaw)
-            position, _ = p.getBasePositionAndOrientation(
-                self.base_id, physicsClientId=self.client_id
-            )
-            p.resetBasePositionAndOrientation(
-                self.base_id, position, orientation, physicsClientId=self.client_id
-            )
-            self.sim_sync_base_arm_pose()
+            orientation = _yaw_quat(target_yaw)
+            self._reset_base_and_arm(position, orientation)
 
             self.client.run(5)
 
@@ -250,23 +305,44 @@ class Bestman_sim:
         Args:
             output (float): The output of the PID controller, which is used to calculate the new position of the robot's base.
         """
+        position, orientation, heading = self._get_base_pose_and_heading()
+        self._nav_step(position, orientation, heading, output)
+
+    def _get_base_pose_and_heading(self):
+        """
+        Read the base pose from pybullet together with its heading.
+
+        Returns:
+            tuple: The base position, orientation (quaternion) and heading as the (x, y) components of its forward axis.
+        """
         position, orientation = p.getBasePositionAndOrientation(
             self.base_id, physicsClientId=self.client_id
         )
-        euler_angles = p.getEulerFromQuaternion(
-            orientation, physicsClientId=self.client_id
-        )
-        p.resetBasePositionAndOrientation(
-            self.base_id,
-            [
-                position[0] + output * math.cos(euler_angles[2]),
-                position[1] + output * math.sin(euler_angles[2]),
-                position[2],
-            ],
-            orientation,
-            physicsClientId=self.client_id,
-        )
-        self.sim_sync_base_arm_pose()
+        # rotate the x axis by the quaternion, no euler conversion needed
+        x, y, z, w = orientation
+        heading = (1 - 2 * (y * y + z * z), 2 * (x * y + w * z))
+        return position, orientation, heading
+
+    def _nav_step(self, position, orientation, heading, output):
+        """
+        Move the base (and the arm with it) along its heading by the PID controller's output.
+
+        Args:
+            position (list): The current base position.
+            orientation (list): The current base orientation as a quaternion.
+            heading (tuple): The (x, y) components of the base forward axis.
+            output (float): The distance to move along the heading.
+
+        Returns:
+            list: The new base position.
+        """
+        new_position = [
+            position[0] + output * heading[0],
+            position[1] + output * heading[1],
+            position[2],
+        ]
+        self._reset_base_and_arm(new_position, orientation)
+        return new_position
 
     def sim_move_base_to_waypoint(self, waypoint, threshold=0.01):
         """
@@ -282,28 +358,34 @@ class Bestman_sim:
         self.base_rotated = False
         cnt = 1
 
+        target_x, target_y = waypoint.x, waypoint.y
+        self.distance_controller.set_goal(self.target_distance)
+
+        # The base only moves through the resets below, so its pose is tracked
+        # locally and re-read from pybullet only after rotating or stepping
+        position, orientation, heading = self._get_base_pose_and_heading()
+
         while True:
-            pose = self.sim_get_current_base_pose()
-            target = self.next_waypoint
-            x, y = pose.x, pose.y
+            dx, dy = target_x - position[0], target_y - position[1]
 
-            distance = math.sqrt((target.y - y) ** 2 + (target.x - x) ** 2)
+            distance = math.hypot(dx, dy)
             if distance < threshold:
                 break
 
-            self.distance_controller.set_goal(self.target_distance)
             output = self.distance_controller.calculate(distance)
 
-            yaw = math.atan2(target.y - y, target.x - x)
+            yaw = math.atan2(dy, dx)
 
             if not self.base_rotated:
                 self.sim_rotate_base(yaw)
                 self.base_rotated = True
+                position, orientation, heading = self._get_base_pose_and_heading()
 
-            self.sim_action(-output)
+            position = self._nav_step(position, orientation, heading, -output)
 
             if cnt % 20 == 0:
                 self.client.run()
+                position, orientation, heading = self._get_base_pose_and_heading()
 
             cnt += 1
 
@@ -353,9 +435,7 @@ class Bestman_sim:
             goal_orientation: The desired goal orientation for the target object.
         """
         current_base_pose = self.sim_get_current_base_pose()
-        distance = np.linalg.norm(
-            np.array(current_base_pose.get_position()) - np.array(goal_pose.get_position())
-        )
+        distance = math.dist(current_base_pose.get_position(), goal_pose.get_position())
         return distance
 
     # ----------------------------------------------------------------
@@ -396,7 +476,7 @@ class Bestman_sim:
         Returns:
             list: A list of indices for the joints in the robot arm.
         """
-        return list(range(p.getNumJoints(self.arm_id, physicsClientId=self.client_id)))
+        return list(self._arm_all_joint_idx)
 
     def sim_get_tcp_link(self):
         """
@@ -484,6 +564,21 @@ class Bestman_sim:
         )
         return Pose(end_effector_info[0], end_effector_info[1])
 
+    def _sim_get_current_end_effector_pose_fast(self):
+        """
+        Retrieve arm's end effect information into a reused Pose buffer.
+
+        The returned Pose is overwritten by the next call, so only use it for
+        immediate reads and never keep a reference to it.
+        """
+        end_effector_info = p.getLinkState(
+            bodyUniqueId=self.arm_id,
+            linkIndex=self.end_effector_index,
+            physicsClientId=self.client_id,
+        )
+        self._ee_pose_buf.set(end_effector_info[0], end_effector_info[1])
+        return self._ee_pose_buf
+
     def sim_set_arm_to_joint_values(self, joint_values):
         """
         Set arm to move to a specific set of joint angles, witout considering physics
@@ -491,8 +586,19 @@ class Bestman_sim:
         Args:
             joint_values: A list of desired joint angles (in radians) for each joint of the arm.
         """
-        for joint, value in zip(self.arm_joints_idx, joint_values):
-            p.resetJointState(self.arm_id, joint, value, targetVelocity=0)
+        if hasattr(p, "resetJointStatesMultiDof"):
+            # joint_values may be an OMPL state, which only supports indexing
+            pairs = list(zip(self.arm_joints_idx, joint_values))
+            p.resetJointStatesMultiDof(
+                self.arm_id,
+                jointIndices=[joint for joint, _ in pairs],
+                targetValues=[[value] for _, value in pairs],
+                targetVelocities=[[0]] * len(pairs),
+                physicsClientId=self.client_id,
+            )
+        else:
+            for joint, value in zip(self.arm_joints_idx, joint_values):
+                p.resetJointState(self.arm_id, joint, value, targetVelocity=0)
         self.client.run(10)
 
     def sim_debug_set_arm_to_joint_values(self):
@@ -536,12 +642,15 @@ class Bestman_sim:
             )
         )
 
-    def sim_move_arm_to_joint_values(self, joint_values, threshold=0.015, timeout=0.05):
+    def sim_move_arm_to_joint_values(
+        self, joint_values, threshold=0.015, timeout=0.05, steps=40
+    ):
         """
         Move arm to move to a specific set of joint angles, with considering physics
 
         Args:
             joint_values: A list of desired joint angles (in radians) for each joint of the arm.
+            steps (int, optional): Number of simulation steps to run after setting the targets.
         """
 
         p.setJointMotorControlArray(
@@ -573,7 +682,7 @@ class Bestman_sim:
         #         # print("-" * 20 + "\n" + "Timeout before reaching target joint position.")
         #         break
         
-        self.client.run(40)
+        self.client.run(steps)
 
     def sim_joints_to_cartesian(self, joint_values):
         """
@@ -599,18 +708,24 @@ class Bestman_sim:
         position = end_effector_info[0]
         return Pose(position, orientation)
 
-    def sim_cartesian_to_joints(self, pose, max_iterations=1000, threshold=1e-4):
+    def sim_cartesian_to_joints(
+        self, pose, max_iterations=1000, threshold=1e-4, current_positions=None
+    ):
         """
         Transforms the robot arm's Cartesian coordinates to its joint angles.
 
         Args:
             position (list): The Cartesian position of the robot arm.
             orientation (list): The Cartesian orientation of the robot arm.
+            current_positions (list, optional): Joint values of every movable joint to seed the solver with. Defaults to the current arm state.
 
         Returns:
             list: A list of joint angles corresponding to the given Cartesian coordinates.
         """
-        joint_values = p.calculateInverseKinematics(
+        seed = {}  # without currentPositions, pybullet starts from the arm state
+        if current_positions is not None:
+            seed["currentPositions"] = current_positions
+        self._last_joint_solution = p.calculateInverseKinematics(
             bodyUniqueId=self.arm_id,
             endEffectorLinkIndex=self.end_effector_index,
             targetPosition=pose.get_position(),
@@ -620,9 +735,10 @@ class Bestman_sim:
             jointRanges=self.arm_joint_ranges,
             restPoses=self.arm_reset_jointValues,
             maxNumIterations=max_iterations,
-            residualThreshold=threshold
-        )[: self.DOF]
-        return joint_values
+            residualThreshold=threshold,
+            **seed,
+        )
+        return self._last_joint_solution[: self.DOF]
 
     def sim_rotate_end_effector(self, angle):
         """
@@ -676,17 +792,18 @@ class Bestman_sim:
         """
 
         start_pose = self.sim_get_current_end_effector_pose()
-        for t in np.linspace(0, 1, steps):
-            interpolated_position = (1 - t) * np.array(
-                start_pose.get_position()
-            ) + t * np.array(end_effector_goal_pose.get_position())
-            interpolated_orientation = p.getQuaternionSlerp(
-                start_pose.get_orientation(),
-                end_effector_goal_pose.get_orientation(),
-                t
-            )
+        positions, orientations = _interpolate_poses(
+            start_pose, end_effector_goal_pose, steps
+        )
+        seed = None  # seed each waypoint's IK with the previous full solution
+        for interpolated_position, interpolated_orientation in zip(
+            positions, orientations
+        ):
             interpolated_pose = Pose(interpolated_position, interpolated_orientation)
-            joint_values = self.sim_cartesian_to_joints(interpolated_pose)
+            joint_values = self.sim_cartesian_to_joints(
+                interpolated_pose, current_positions=seed
+            )
+            seed = self._last_joint_solution
             self.sim_move_arm_to_joint_values(joint_values)
             # if len(p.getContactPoints(self.arm_id)) > 0:
             #     print(
@@ -701,22 +818,47 @@ class Bestman_sim:
             
         print("[BestMan_Sim][Arm] \033[34mInfo\033[0m: Move end effector to goal pose finished!")
 
-    def sim_execute_trajectory(self, trajectory, threshold=0.1, enable_plot=False):
+    def sim_execute_trajectory(
+        self,
+        trajectory,
+        threshold=0.1,
+        enable_plot=False,
+        steps_per_waypoint=40,
+        adaptive_steps=False,
+    ):
         """Execute the path planned by Planner
 
         Args:
             trajectory: List, each element is a list of angles, corresponding to a transformation
+            steps_per_waypoint (int, optional): Simulation steps to run per waypoint.
+            adaptive_steps (bool, optional): If True, scale each waypoint's steps by its joint travel
+                (at most steps_per_waypoint). Faster on dense plans, but the arm lags behind the planned path.
         """
 
+        if adaptive_steps:
+            previous_joint_values = np.asarray(self.sim_get_current_joint_values())
         for i in range(len(trajectory)):
-            self.sim_move_arm_to_joint_values(trajectory[i])
+            steps = steps_per_waypoint
+            if adaptive_steps:
+                joint_values = np.asarray(trajectory[i])
+                steps = self._sim_waypoint_steps(
+                    previous_joint_values, joint_values, max_steps=steps_per_waypoint
+                )
+                previous_joint_values = joint_values
+            self.sim_move_arm_to_joint_values(trajectory[i], steps=steps)
+
+            # the end effector pose is only needed to draw the trajectory
+            if not enable_plot:
+                continue
 
             # if i % 3 == 0:
             # self.visualizer.draw_link_pose(self.arm_id, self.end_effector_index)
-            current_point = self.sim_get_current_end_effector_pose().get_position()
+            current_point = (
+                self._sim_get_current_end_effector_pose_fast().get_position()
+            )
 
             # draw the trajectory
-            if i != 0 and enable_plot:
+            if i != 0:
                 p.addUserDebugLine(
                     front_point,
                     current_point,
@@ -730,9 +872,10 @@ class Bestman_sim:
         self.client.run(40)
 
         current_joint_values = self.sim_get_current_joint_values()
-        diff_angles = [abs(a - b) for a, b in zip(current_joint_values, trajectory[-1])]
-        greater_than_threshold = [diff for diff in diff_angles if diff > threshold]
-        greater_num = len(greater_than_threshold)
+        diff_angles = np.abs(
+            np.asarray(current_joint_values) - np.asarray(trajectory[-1])
+        )
+        greater_num = int(np.count_nonzero(diff_angles > threshold))
         if greater_num > 0:
             print(
                 f"[BestMan_Sim][Arm] \033[33mwarning\033[0m: The robot arm({greater_num} joints) don't reach the specified position!"
@@ -740,6 +883,31 @@ class Bestman_sim:
 
         print("[BestMan_Sim][Arm] \033[34mInfo\033[0m: Excite trajectory finished!")
 
+    def _sim_waypoint_steps(self, start_joint_values, goal_joint_values, max_steps=40):
+        """
+        Estimate the fewest simulation steps to travel between two waypoints.
+
+        This assumes every joint moves at its URDF velocity limit right away. Position
+        control closes the gap gradually, so the arm has not reached the goal after
+        this many steps; it is a lower bound, not the steps needed to reach it.
+
+        Args:
+            start_joint_values (np.ndarray): The joint values the arm moves from.
+            goal_joint_values (np.ndarray): The joint values the arm moves to.
+            max_steps (int, optional): Upper bound on the number of steps.
+
+        Returns:
+            int: Number of simulation steps, between 2 and max_steps.
+        """
+        # joints without a velocity limit in the URDF report 0, keep the fixed budget
+        if not np.all(self.arm_max_velocities > 0):
+            return max_steps
+        travel_time = np.max(
+            np.abs(goal_joint_values - start_joint_values) / self.arm_max_velocities
+        )
+        steps = math.ceil(travel_time / self.client.timestep)
+        return int(min(max(steps, 2), max_steps))
+
     def sim_calculate_IK_error(self, goal_pose):
         """Calculate the inverse kinematics (IK) error for performing pick-and-place manipulation of an object using a robot arm.
 
@@ -748,10 +916,8 @@ class Bestman_sim:
             goal_orientation: The desired goal orientation for the target object.
         """
 
-        end_effector_pose = self.sim_get_current_end_effector_pose()
-        distance = np.linalg.norm(
-            np.array(end_effector_pose.get_position()) - np.array(goal_pose.get_position())
-        )
+        end_effector_pose = self._sim_get_current_end_effector_pose_fast()
+        distance = math.dist(end_effector_pose.get_position(), goal_pose.get_position())
         return distance
 
     # ----------------------------------------------------------------
@@ -791,16 +957,21 @@ class Bestman_sim:
 
         return robot_size
 
-    def sim_sync_base_arm_pose(self):
+    def sim_sync_base_arm_pose(self, position=None, orientation=None):
         """
         Synchronizes the pose of the robot arm with the base.
 
         This function ensures that the positions of the robot arm and base are aligned.
+
+        Args:
+            position (list, optional): The current base position. Read from pybullet if not given.
+            orientation (list, optional): The current base orientation. Read from pybullet if not given.
         """
 
-        position, orientation = p.getBasePositionAndOrientation(
-            self.base_id, physicsClientId=self.client_id
-        )
+        if position is None or orientation is None:
+            position, orientation = p.getBasePositionAndOrientation(
+                self.base_id, physicsClientId=self.client_id
+            )
         if self.arm_id is not None:
             p.resetBasePositionAndOrientation(
                 self.arm_id,
@@ -809,6 +980,19 @@ class Bestman_sim:
                 physicsClientId=self.client_id,
             )
 
+    def _reset_base_and_arm(self, position, orientation):
+        """
+        Resets the base to the given pose and moves the arm along with it.
+
+        Args:
+            position (list): The new base position.
+            orientation (list): The new base orientation as a quaternion.
+        """
+        p.resetBasePositionAndOrientation(
+            self.base_id, position, orientation, physicsClientId=self.client_id
+        )
+        self.sim_sync_base_arm_pose(position, orientation)
+
     # ----------------------------------------------------------------
     # functions for camera
     # ----------------------------------------------------------------
@@ -51,6 +51,18 @@ class Pose:
                 "[Pose] \033[31merror\033[0m: Orientation input must be Rotation matrix / Quaternion / Euler angles"
             )
         
+    def set(self, position, orientation):
+        """
+        Update the pose in place.
+
+        Args:
+            position (list / np.ndarray): A list or array of three floats representing the position in 3D space.
+            orientation (list / tuple / np.ndarray): A quaternion (4 elements).
+        """
+        self.position = list(position)
+        self.x, self.y, self.z = position
+        self.orientation = list(orientation)
+
     def get_position(self):
         """
         get position
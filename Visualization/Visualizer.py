@@ -36,6 +36,7 @@ class Visualizer:
         """
         self.client = client
         self.client_id = client.get_client_id()
+        self.logId = None  # video logging id
         self.set_camera_pose(visualizer_cfg.Camera)  # Init camera pose
 
     # ----------------------------------------------------------------
@@ -180,6 +181,11 @@ class Visualizer:
         Args:
             fileName (str): The filename for the video file.
         """
+        # MP4 logging needs the GUI renderer, skip it in DIRECT mode
+        if not self.client.enable_GUI:
+            self.logId = None
+            return
+
         self.logId = p.startStateLogging(
             p.STATE_LOGGING_VIDEO_MP4,
             "../Examples/log/" + fileName + ".mp4",
@@ -192,6 +198,8 @@ class Visualizer:
 
     def end_record(self):
         """Stops recording the video."""
+        if self.logId is None:
+            return
         p.stopStateLogging(self.logId, physicsClientId=self.client_id)
 
     # ----------------------------------------------------------------
@@ -1,7 +1,9 @@
+import json
 import pickle
 from os.path import basename, join, splitext
 
 import bpy
+import numpy as np
 from bpy.props import CollectionProperty, StringProperty
 from bpy.types import Operator, OperatorFileListElement, Panel
 from bpy_extras.io_utils import ImportHelper
@@ -18,6 +20,45 @@ bl_info = {
 }
 
 
+def load_simulation(filepath):
+    """
+    Loads a recorded simulation into the per-link frame format.
+
+    Args:
+        filepath (str): Path to an ``.npz`` recording (with its ``.json`` sidecar)
+            or a legacy ``.pkl`` recording.
+
+    Returns:
+        dict: Link name to its type, mesh path, mesh scale and list of frames.
+    """
+    if splitext(filepath)[1].lower() != ".npz":
+        with open(filepath, "rb") as pickle_file:
+            return pickle.load(pickle_file)
+
+    with open(splitext(filepath)[0] + ".json", "r") as json_file:
+        metadata = json.load(json_file)
+    with np.load(filepath) as recording:
+        frames = recording["frames"].tolist()
+        positions = recording["positions"]
+        orientations = recording["orientations"]
+        names = recording["names"].tolist()
+
+    data = {}
+    for i, name in enumerate(names):
+        # links registered mid-recording are NaN before their first frame
+        valid = ~np.isnan(positions[:, i, 0])
+        data[name] = dict(metadata[name])
+        data[name]["frames"] = [
+            {
+                "position": positions[f, i].tolist(),
+                "orientation": orientations[f, i].tolist(),
+                "frame": frames[f],
+            }
+            for f in np.flatnonzero(valid)
+        ]
+    return data
+
+
 class ANIM_OT_import_pybullet_sim(Operator, ImportHelper):
     """Operator for importing PyBullet simulation results."""
 
@@ -30,8 +71,8 @@ class ANIM_OT_import_pybullet_sim(Operator, ImportHelper):
         type=OperatorFileListElement,
     )
     directory: StringProperty(subtype="DIR_PATH")
-    filename_ext = ".pkl"
-    filter_glob: StringProperty(default="*.pkl", options={"HIDDEN"})
+    filename_ext = ".npz"
+    filter_glob: StringProperty(default="*.npz;*.pkl", options={"HIDDEN"})
     skip_frames: bpy.props.IntProperty(name="Skip Frames", default=3, min=1, max=100)
     max_frames: bpy.props.IntProperty(name="Max Frames", default=-1, min=-1, max=10000)
 
@@ -48,154 +89,149 @@ class ANIM_OT_import_pybullet_sim(Operator, ImportHelper):
         for file in self.files:
             filepath = join(self.directory, file.name)
             print(f"Processing {filepath}")
-            with open(filepath, "rb") as pickle_file:
-                data = pickle.load(pickle_file)
-                collection_name = splitext(basename(filepath))[0]
-                collection = bpy.data.collections.new(collection_name)
-                bpy.context.scene.collection.children.link(collection)
-                context.view_layer.active_layer_collection = (
-                    context.view_layer.layer_collection.children[-1]
-                )
-
-                for obj_key in data:
-                    pybullet_obj = data[obj_key]
-                    if pybullet_obj["type"] == "mesh":
-                        # Load mesh of each link
-                        extension = pybullet_obj["mesh_path"].split(".")[-1].lower()
-                        # Handle different mesh formats
-                        if "obj" in extension:
-                            bpy.ops.import_scene.obj(
-                                filepath=pybullet_obj["mesh_path"],
-                                axis_forward="Y",
-                                axis_up="Z",
-                            )
-                        elif "dae" in extension:
-                            bpy.ops.wm.collada_import(
-                                filepath=pybullet_obj["mesh_path"]
-                            )
-                        elif "stl" in extension:
-                            bpy.ops.import_mesh.stl(filepath=pybullet_obj["mesh_path"])
-                        else:
-                            print("Unsupported File Format:{}".format(extension))
-                            pass
-
-                        # Delete lights and camera
-                        parts = 0
-                        final_objs = []
-                        for import_obj in context.selected_objects:
-                            bpy.ops.object.select_all(action="DESELECT")
-                            import_obj.select_set(True)
-                            if (
-                                "Camera" in import_obj.name
-                                or "Light" in import_obj.name
-                                or "Lamp" in import_obj.name
-                            ):
-                                bpy.ops.object.delete(use_global=True)
-                            else:
-                                scale = pybullet_obj["mesh_scale"]
-                                if scale is not None and "dae" not in extension:
-                                    # if scale is not None:
-                                    import_obj.scale.x = scale[0]
-                                    import_obj.scale.y = scale[1]
-                                    import_obj.scale.z = scale[2]
-                                final_objs.append(import_obj)
-                                parts += 1
-                        bpy.ops.object.select_all(action="DESELECT")
-                        for obj in final_objs:
-                            if obj.type == "MESH":
-                                obj.select_set(True)
-                        if len(context.selected_objects):
-                            context.view_layer.objects.active = (
-                                context.selected_objects[0]
-                            )
-                            # join them
-                            bpy.ops.object.join()
-                        blender_obj = context.view_layer.objects.active
-                        blender_obj.name = obj_key
-
-                    elif pybullet_obj["type"] == "box":
-                        size = pybullet_obj[
-                            "mesh_scale"
-                        ]  # Assuming mesh_scale contains box dimensions
-                        bpy.ops.mesh.primitive_cube_add(
-                            size=1.0,
-                            enter_editmode=False,
-                            align="WORLD",
-                            location=(0, 0, 0),
-                            scale=(size[0], size[1], size[2]),
-                        )
-                        blender_obj = context.view_layer.objects.active
-                        blender_obj.name = obj_key
-
-                    elif pybullet_obj["type"] == "cylinder":
-                        length = pybullet_obj["mesh_scale"][
-                            0
-                        ]  # Assuming mesh_scale contains cylinder dimensions: [length, radius, radius]
-                        radius = pybullet_obj["mesh_scale"][1]
-                        bpy.ops.mesh.primitive_cylinder_add(
-                            radius=radius,
-                            depth=length,
-                            enter_editmode=False,
-                            align="WORLD",
-                            location=(0, 0, 0),
+            data = load_simulation(filepath)
+            collection_name = splitext(basename(filepath))[0]
+            collection = bpy.data.collections.new(collection_name)
+            bpy.context.scene.collection.children.link(collection)
+            context.view_layer.active_layer_collection = (
+                context.view_layer.layer_collection.children[-1]
+            )
+
+            for obj_key in data:
+                pybullet_obj = data[obj_key]
+                if pybullet_obj["type"] == "mesh":
+                    # Load mesh of each link
+                    extension = pybullet_obj["mesh_path"].split(".")[-1].lower()
+                    # Handle different mesh formats
+                    if "obj" in extension:
+                        bpy.ops.import_scene.obj(
+                            filepath=pybullet_obj["mesh_path"],
+                            axis_forward="Y",
+                            axis_up="Z",
                         )
-                        blender_obj = context.view_layer.objects.active
-                        blender_obj.name = obj_key
+                    elif "dae" in extension:
+                        bpy.ops.wm.collada_import(filepath=pybullet_obj["mesh_path"])
+                    elif "stl" in extension:
+                        bpy.ops.import_mesh.stl(filepath=pybullet_obj["mesh_path"])
+                    else:
+                        print("Unsupported File Format:{}".format(extension))
+                        pass
 
-                        # 删除灯光和摄像机（在生成圆柱体后）
+                    # Delete lights and camera
+                    parts = 0
+                    final_objs = []
+                    for import_obj in context.selected_objects:
                         bpy.ops.object.select_all(action="DESELECT")
-                        blender_obj.select_set(True)
-                        for import_obj in context.selected_objects:
-                            if (
-                                "Camera" in import_obj.name
-                                or "Light" in import_obj.name
-                                or "Lamp" in import_obj.name
-                            ):
-                                bpy.ops.object.delete(use_global=True)
-
-                    # mat = bpy.data.materials.new(name="Material")
-                    # mat.use_nodes = True
-                    # bsdf = mat.node_tree.nodes["Principled BSDF"]
-                    # bsdf.inputs['Base Color'].default_value = pybullet_obj['rgba']
-                    # if len(blender_obj.data.materials):
-                    #     blender_obj.data.materials[0] = mat
-                    # else:
-                    #     blender_obj.data.materials.append(mat)
-
-                    # 确保对象的视口显示模式为材质预览或渲染
-                    bpy.context.area.ui_type = "VIEW_3D"
-                    for area in bpy.context.screen.areas:
-                        if area.type == "VIEW_3D":
-                            for space in area.spaces:
-                                if space.type == "VIEW_3D":
-                                    space.shading.type = "MATERIAL"
-
-                    # Keyframe motion of imported object
-                    for _, frame_data in enumerate(pybullet_obj["frames"]):
-
-                        frame_count = frame_data["frame"]
-                        if frame_count % self.skip_frames != 0:
-                            continue
-                        if self.max_frames > 1 and frame_count > self.max_frames:
-                            print("Exceed max frame count")
-                            break
-
-                        pos = frame_data["position"]
-                        orn = frame_data["orientation"]
-                        context.scene.frame_set(frame_count // self.skip_frames)
-
-                        # Apply position and rotation
-                        blender_obj.location.x = pos[0]
-                        blender_obj.location.y = pos[1]
-                        blender_obj.location.z = pos[2]
-                        blender_obj.rotation_mode = "QUATERNION"
-                        blender_obj.rotation_quaternion.x = orn[0]
-                        blender_obj.rotation_quaternion.y = orn[1]
-                        blender_obj.rotation_quaternion.z = orn[2]
-                        blender_obj.rotation_quaternion.w = orn[3]
-
-                        bpy.ops.anim.keyframe_insert_menu(type="Rotation")
-                        bpy.ops.anim.keyframe_insert_menu(type="Location")
+                        import_obj.select_set(True)
+                        if (
+                            "Camera" in import_obj.name
+                            or "Light" in import_obj.name
+                            or "Lamp" in import_obj.name
+                        ):
+                            bpy.ops.object.delete(use_global=True)
+                        else:
+                            scale = pybullet_obj["mesh_scale"]
+                            if scale is not None and "dae" not in extension:
+                                # if scale is not None:
+                                import_obj.scale.x = scale[0]
+                                import_obj.scale.y = scale[1]
+                                import_obj.scale.z = scale[2]
+                            final_objs.append(import_obj)
+                            parts += 1
+                    bpy.ops.object.select_all(action="DESELECT")
+                    for obj in final_objs:
+                        if obj.type == "MESH":
+                            obj.select_set(True)
+                    if len(context.selected_objects):
+                        context.view_layer.objects.active = context.selected_objects[0]
+                        # join them
+                        bpy.ops.object.join()
+                    blender_obj = context.view_layer.objects.active
+                    blender_obj.name = obj_key
+
+                elif pybullet_obj["type"] == "box":
+                    size = pybullet_obj[
+                        "mesh_scale"
+                    ]  # Assuming mesh_scale contains box dimensions
+                    bpy.ops.mesh.primitive_cube_add(
+                        size=1.0,
+                        enter_editmode=False,
+                        align="WORLD",
+                        location=(0, 0, 0),
+                        scale=(size[0], size[1], size[2]),
+                    )
+                    blender_obj = context.view_layer.objects.active
+                    blender_obj.name = obj_key
+
+                elif pybullet_obj["type"] == "cylinder":
+                    length = pybullet_obj["mesh_scale"][
+                        0
+                    ]  # Assuming mesh_scale contains cylinder dimensions: [length, radius, radius]
+                    radius = pybullet_obj["mesh_scale"][1]
+                    bpy.ops.mesh.primitive_cylinder_add(
+                        radius=radius,
+                        depth=length,
+                        enter_editmode=False,
+                        align="WORLD",
+                        location=(0, 0, 0),
+                    )
+                    blender_obj = context.view_layer.objects.active
+                    blender_obj.name = obj_key
+
+                    # 删除灯光和摄像机（在生成圆柱体后）
+                    bpy.ops.object.select_all(action="DESELECT")
+                    blender_obj.select_set(True)
+                    for import_obj in context.selected_objects:
+                        if (
+                            "Camera" in import_obj.name
+                            or "Light" in import_obj.name
+                            or "Lamp" in import_obj.name
+                        ):
+                            bpy.ops.object.delete(use_global=True)
+
+                # mat = bpy.data.materials.new(name="Material")
+                # mat.use_nodes = True
+                # bsdf = mat.node_tree.nodes["Principled BSDF"]
+                # bsdf.inputs['Base Color'].default_value = pybullet_obj['rgba']
+                # if len(blender_obj.data.materials):
+                #     blender_obj.data.materials[0] = mat
+                # else:
+                #     blender_obj.data.materials.append(mat)
+
+                # 确保对象的视口显示模式为材质预览或渲染
+                bpy.context.area.ui_type = "VIEW_3D"
+                for area in bpy.context.screen.areas:
+                    if area.type == "VIEW_3D":
+                        for space in area.spaces:
+                            if space.type == "VIEW_3D":
+                                space.shading.type = "MATERIAL"
+
+                # Keyframe motion of imported object
+                for _, frame_data in enumerate(pybullet_obj["frames"]):
+
+                    frame_count = frame_data["frame"]
+                    if frame_count % self.skip_frames != 0:
+                        continue
+                    if self.max_frames > 1 and frame_count > self.max_frames:
+                        print("Exceed max frame count")
+                        break
+
+                    pos = frame_data["position"]
+                    orn = frame_data["orientation"]
+                    context.scene.frame_set(frame_count // self.skip_frames)
+
+                    # Apply position and rotation
+                    blender_obj.location.x = pos[0]
+                    blender_obj.location.y = pos[1]
+                    blender_obj.location.z = pos[2]
+                    blender_obj.rotation_mode = "QUATERNION"
+                    blender_obj.rotation_quaternion.x = orn[0]
+                    blender_obj.rotation_quaternion.y = orn[1]
+                    blender_obj.rotation_quaternion.z = orn[2]
+                    blender_obj.rotation_quaternion.w = orn[3]
+
+                    bpy.ops.anim.keyframe_insert_menu(type="Rotation")
+                    bpy.ops.anim.keyframe_insert_menu(type="Location")
 
         return {"FINISHED"}
 
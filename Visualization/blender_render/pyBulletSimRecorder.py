@@ -8,18 +8,174 @@
 # @Description:   : A recorder in pybullet sim and the result can be import into blender scene
 """
 
-import os
+import bisect
+import functools
+import json
 
 # import PySimpleGUI as sg
 import pickle
-from os.path import abspath, basename, dirname, splitext
+from os.path import abspath, basename, dirname, join, splitext
 
 import numpy as np
 import pybullet as p
-from transforms3d.affines import decompose
-from transforms3d.quaternions import mat2quat
 from urdfpy import URDF
 
+_I4 = np.eye(4)
+_FRAME_CHUNK = 256  # initial keyframe capacity, doubled whenever it runs out
+
+
+@functools.lru_cache(maxsize=128)
+def _load_urdf(path_abs):
+    """
+    Loads a URDF, reusing the parsed tree for files registered more than once.
+
+    The returned URDF is shared between callers and must be treated as read-only.
+
+    Args:
+        path_abs (str): The absolute path to the URDF file.
+
+    Returns:
+        URDF: The parsed URDF.
+    """
+    return URDF.load(path_abs)
+
+
+def _classify(geometry, global_scaling, dir_path):
+    """
+    Gets the exported type, scale and mesh path of a URDF visual geometry.
+
+    Args:
+        geometry (urdfpy.Geometry): The visual geometry.
+        global_scaling (float): The global scaling factor for the object.
+        dir_path (str): The directory of the URDF file, for relative mesh paths.
+
+    Returns:
+        tuple: The type ('mesh', 'box' or 'cylinder'), the scale and the mesh
+            path (None for primitives), or (None, None, None) if unsupported.
+    """
+    if geometry.mesh is not None:
+        mesh_scale = (
+            [global_scaling, global_scaling, global_scaling]
+            if geometry.mesh.scale is None
+            else geometry.mesh.scale * global_scaling
+        )
+        return "mesh", mesh_scale, join(dir_path, geometry.mesh.filename)
+
+    if geometry.box is not None:
+        box_size = geometry.box.size
+        assert len(box_size) == 3, "wrong box size, please check object urdf file!"
+        return "box", box_size, None  # Use box size as scale
+
+    if geometry.cylinder is not None:
+        return "cylinder", [geometry.cylinder.length, geometry.cylinder.radius], None
+
+    return None, None, None
+
+
+def _compose_poses(parent_positions, parent_orientations, positions, orientations):
+    """
+    Composes parent poses with local poses, like a batched p.multiplyTransforms.
+
+    Args:
+        parent_positions (np.ndarray): (N, 3) parent positions.
+        parent_orientations (np.ndarray): (N, 4) parent quaternions in xyzw order.
+        positions (np.ndarray): (N, 3) local positions.
+        orientations (np.ndarray): (N, 4) local quaternions in xyzw order.
+
+    Returns:
+        tuple: (N, 3) world positions and (N, 4) world quaternions in xyzw order.
+    """
+    px, py, pz, pw = parent_orientations.T
+    lx, ly, lz, lw = orientations.T
+
+    # rotate the local positions: v + 2w(q x v) + 2q x (q x v)
+    q = parent_orientations[:, :3]
+    t = 2 * np.cross(q, positions)
+    world_positions = parent_positions + positions + pw[:, None] * t + np.cross(q, t)
+
+    world_orientations = np.stack(
+        [
+            pw * lx + px * lw + py * lz - pz * ly,
+            pw * ly - px * lz + py * lw + pz * lx,
+            pw * lz + px * ly - py * lx + pz * lw,
+            pw * lw - px * lx - py * ly - pz * lz,
+        ],
+        axis=1,
+    )
+    return world_positions, world_orientations
+
+
+def _mat_to_quat(mats):
+    """
+    Converts rotation matrices to quaternions with Shepperd's method.
+
+    Args:
+        mats (np.ndarray): (N, 3, 3) rotation matrices.
+
+    Returns:
+        np.ndarray: (N, 4) quaternions in xyzw order, with w >= 0.
+    """
+    m = mats
+    quats = np.empty((len(m), 4))
+    trace = m[:, 0, 0] + m[:, 1, 1] + m[:, 2, 2]
+
+    # pick the numerically largest component for each matrix
+    case_w = trace > 0
+    case_x = ~case_w & (m[:, 0, 0] >= m[:, 1, 1]) & (m[:, 0, 0] >= m[:, 2, 2])
+    case_y = ~case_w & ~case_x & (m[:, 1, 1] >= m[:, 2, 2])
+    case_z = ~(case_w | case_x | case_y)
+
+    r = m[case_w]
+    s = 2 * np.sqrt(1 + trace[case_w])
+    quats[case_w] = np.stack(
+        [
+            (r[:, 2, 1] - r[:, 1, 2]) / s,
+            (r[:, 0, 2] - r[:, 2, 0]) / s,
+            (r[:, 1, 0] - r[:, 0, 1]) / s,
+            s / 4,
+        ],
+        axis=1,
+    )
+
+    r = m[case_x]
+    s = 2 * np.sqrt(1 + r[:, 0, 0] - r[:, 1, 1] - r[:, 2, 2])
+    quats[case_x] = np.stack(
+        [
+            s / 4,
+            (r[:, 0, 1] + r[:, 1, 0]) / s,
+            (r[:, 0, 2] + r[:, 2, 0]) / s,
+            (r[:, 2, 1] - r[:, 1, 2]) / s,
+        ],
+        axis=1,
+    )
+
+    r = m[case_y]
+    s = 2 * np.sqrt(1 + r[:, 1, 1] - r[:, 0, 0] - r[:, 2, 2])
+    quats[case_y] = np.stack(
+        [
+            (r[:, 0, 1] + r[:, 1, 0]) / s,
+            s / 4,
+            (r[:, 1, 2] + r[:, 2, 1]) / s,
+            (r[:, 0, 2] - r[:, 2, 0]) / s,
+        ],
+        axis=1,
+    )
+
+    r = m[case_z]
+    s = 2 * np.sqrt(1 + r[:, 2, 2] - r[:, 0, 0] - r[:, 1, 1])
+    quats[case_z] = np.stack(
+        [
+            (r[:, 0, 2] + r[:, 2, 0]) / s,
+            (r[:, 1, 2] + r[:, 2, 1]) / s,
+            s / 4,
+            (r[:, 1, 0] - r[:, 0, 1]) / s,
+        ],
+        axis=1,
+    )
+
+    quats[quats[:, 3] < 0] *= -1
+    return quats
+
 
 class PyBulletRecorder:
     """A class for recording PyBullet simulations."""
@@ -27,8 +183,26 @@ class PyBulletRecorder:
     class LinkTracker:
         """Tracks the state of a link in the simulation."""
 
+        __slots__ = (
+            "type",
+            "name",
+            "body_id",
+            "link_id",
+            "link_pose",
+            "mesh_path",
+            "mesh_scale",
+        )
+
         def __init__(
-            self, type, name, body_id, link_id, link_origin, mesh_path, mesh_scale
+            self,
+            type,
+            name,
+            body_id,
+            link_id,
+            link_position,
+            link_orientation,
+            mesh_path,
+            mesh_scale,
         ):
             """
             Initializes the LinkTracker class.
@@ -38,7 +212,8 @@ class PyBulletRecorder:
                 name (str): The name of the link.
                 body_id (int): The ID of the body to which the link belongs.
                 link_id (int): The ID of the link.
-                link_origin (np.ndarray): The origin transformation of the link.
+                link_position (np.ndarray): The local position of the link.
+                link_orientation (np.ndarray): The local xyzw orientation of the link.
                 mesh_path (str): The path to the mesh file.
                 mesh_scale (list): The scale of the mesh.
             """
@@ -46,58 +221,25 @@ class PyBulletRecorder:
             self.name = name
             self.body_id = body_id
             self.link_id = link_id
-            decomposed_origin = decompose(link_origin)
-            orn = mat2quat(decomposed_origin[1])
-            orn = [orn[1], orn[2], orn[3], orn[0]]
-            self.link_pose = [decomposed_origin[0], orn]
+            self.link_pose = [link_position, link_orientation]
             self.mesh_path = mesh_path
             self.mesh_scale = mesh_scale
 
-        def transform(self, position, orientation):
-            """
-            Transforms a local pose to a global pose.
-
-            Args:
-                position (list): The position of the link.
-                orientation (list): The orientation of the link.
-
-            Returns:
-                tuple: The transformed position and orientation.
-            """
-            return p.multiplyTransforms(
-                position,
-                orientation,
-                self.link_pose[0],
-                self.link_pose[1],
-            )
-
-        def get_keyframe(self):
-            """
-            Gets the global pose of the link.
-
-            Returns:
-                dict: The position and orientation of the link.
-            """
-            if self.link_id == -1:
-                position, orientation = p.getBasePositionAndOrientation(self.body_id)
-                position, orientation = self.transform(
-                    position=position, orientation=orientation
-                )
-            else:
-                link_state = p.getLinkState(
-                    self.body_id, self.link_id, computeForwardKinematics=True
-                )
-                position, orientation = self.transform(
-                    position=link_state[4], orientation=link_state[5]
-                )
-
-            return {"position": list(position), "orientation": list(orientation)}
-
     def __init__(self):
         """Initializes the PyBulletRecorder class."""
         self.frame_cnt = 0
-        self.states = []
         self.links = []
+        # keyframes as a float32 (capacity, N, 7) buffer of xyz + xyzw quaternion
+        # poses, indexed by frame and by link in self.links order; links registered
+        # mid-recording are NaN before their first frame
+        self._poses = np.empty((0, 0, 7), dtype=np.float32)
+        self._first_frames = []  # first recorded frame of each link
+        self._base_links = {}  # body_id -> trackers of base links (link_id == -1)
+        self._joint_links = {}  # body_id -> (link ids, trackers) of other links
+        self._keyframe_links = None  # trackers in keyframe query order, rebuilt lazily
+        self._keyframe_order = None  # their indices in self.links
+        self._link_positions = None  # (N, 3) stack of their local link positions
+        self._link_orientations = None  # (N, 4) stack of their local link quaternions
 
     def register_object(self, body_id, urdf_path, global_scaling):
         """
@@ -108,120 +250,141 @@ class PyBulletRecorder:
             urdf_path (str): The path to the URDF file of the object.
             global_scaling (float): The global scaling factor for the object.
         """
-        link_id_map = dict()
-        n = p.getNumJoints(body_id)
-        link_id_map[p.getBodyInfo(body_id)[0].decode("gb2312")] = (
-            -1
-        )  # object base link id
-        for link_id in range(0, n):
-            link_id_map[
-                p.getJointInfo(body_id, link_id)[12].decode(  # object other link id
-                    "gb2312"
-                )
-            ] = link_id
+        link_names = [
+            p.getJointInfo(body_id, link_id)[12].decode("gb2312")
+            for link_id in range(p.getNumJoints(body_id))
+        ]
+        link_id_map = {p.getBodyInfo(body_id)[0].decode("gb2312"): -1}  # base link id
+        link_id_map.update(
+            {name: link_id for link_id, name in enumerate(link_names)}
+        )  # object other link id
 
-        dir_path = dirname(abspath(urdf_path))
-        file_name = splitext(basename(urdf_path))[0]
-        robot = URDF.load(urdf_path)
+        path_abs = abspath(urdf_path)
+        dir_path = dirname(path_abs)
+        name_prefix = f"{splitext(basename(urdf_path))[0]}_{body_id}_"
+        robot = _load_urdf(path_abs)
+        visuals = []
         for link in robot.links:
             link_id = link_id_map[link.name]
-            if len(link.visuals) > 0:
-                for i, link_visual in enumerate(link.visuals):
-                    if link_visual.geometry.mesh is not None:
-                        mesh_scale = (
-                            [global_scaling, global_scaling, global_scaling]
-                            if link_visual.geometry.mesh.scale is None
-                            else link_visual.geometry.mesh.scale * global_scaling
-                        )
-
-                        self.links.append(
-                            PyBulletRecorder.LinkTracker(
-                                type="mesh",
-                                name=file_name + f"_{body_id}_{link.name}_{i}",
-                                body_id=body_id,
-                                link_id=link_id,
-                                link_origin=  # If link_id == -1 then is base link,
-                                # PyBullet will return
-                                # inertial_origin @ visual_origin,
-                                # so need to undo that transform
-                                (
-                                    np.linalg.inv(link.inertial.origin)
-                                    if link_id == -1
-                                    else np.identity(4)
-                                )
-                                @ link_visual.origin
-                                * global_scaling,
-                                mesh_path=os.path.join(
-                                    dir_path, link_visual.geometry.mesh.filename
-                                ),
-                                # mesh_path=dir_path + '/' + link_visual.geometry.mesh.filename,
-                                mesh_scale=mesh_scale,
-                            )
-                        )
-
-                    elif link_visual.geometry.box is not None:
-                        box_size = link_visual.geometry.box.size
-                        assert (
-                            len(box_size) == 3
-                        ), "wrong box size, please check object urdf file!"
-                        self.links.append(
-                            PyBulletRecorder.LinkTracker(
-                                type="box",  # Specify type as box
-                                name=file_name + f"_{body_id}_{link.name}_{i}",
-                                body_id=body_id,
-                                link_id=link_id,
-                                link_origin=  # If link_id == -1 then is base link,
-                                # PyBullet will return
-                                # inertial_origin @ visual_origin,
-                                # so need to undo that transform
-                                (
-                                    np.linalg.inv(link.inertial.origin)
-                                    if link_id == -1
-                                    else np.identity(4)
-                                )
-                                @ link_visual.origin
-                                * global_scaling,
-                                mesh_path=None,  # No mesh path for boxes
-                                mesh_scale=box_size,  # Use box size as scale
-                            )
-                        )
-
-                    elif link_visual.geometry.cylinder is not None:
-                        length = link_visual.geometry.cylinder.length
-                        radius = link_visual.geometry.cylinder.radius
-                        self.links.append(
-                            PyBulletRecorder.LinkTracker(
-                                type="cylinder",  # Specify type as box
-                                name=file_name + f"_{body_id}_{link.name}_{i}",
-                                body_id=body_id,
-                                link_id=link_id,
-                                link_origin=  # If link_id == -1 then is base link,
-                                # PyBullet will return
-                                # inertial_origin @ visual_origin,
-                                # so need to undo that transform
-                                (
-                                    np.linalg.inv(link.inertial.origin)
-                                    if link_id == -1
-                                    else np.identity(4)
-                                )
-                                @ link_visual.origin
-                                * global_scaling,
-                                mesh_path=None,  # No mesh path for boxes
-                                mesh_scale=[length, radius],  # Use box size as scale
-                            )
-                        )
+            # If link_id == -1 then is base link, PyBullet will return
+            # inertial_origin @ visual_origin, so need to undo that transform
+            inv_inertial = np.linalg.inv(link.inertial.origin) if link_id == -1 else _I4
+            for i, link_visual in enumerate(link.visuals):
+                kind, mesh_scale, mesh_path = _classify(
+                    link_visual.geometry, global_scaling, dir_path
+                )
+                if kind is None:
+                    # sphere and other geometries are not exported
+                    continue
+                visuals.append(
+                    dict(
+                        type=kind,
+                        name=f"{name_prefix}{link.name}_{i}",
+                        body_id=body_id,
+                        link_id=link_id,
+                        link_origin=inv_inertial @ link_visual.origin * global_scaling,
+                        mesh_path=mesh_path,
+                        mesh_scale=mesh_scale,
+                    )
+                )
+
+        if not visuals:
+            return
+
+        # Convert all visual origins in one pass. They carry global_scaling in
+        # every entry, so divide it back out of the rotation to keep it rigid
+        origins = np.array([visual.pop("link_origin") for visual in visuals])
+        link_positions = origins[:, :3, 3]
+        link_orientations = _mat_to_quat(origins[:, :3, :3] / global_scaling)
+        for visual, link_position, link_orientation in zip(
+            visuals, link_positions, link_orientations
+        ):
+            self._track_link(
+                PyBulletRecorder.LinkTracker(
+                    link_position=link_position,
+                    link_orientation=link_orientation,
+                    **visual,
+                )
+            )
+
+    def _track_link(self, link):
+        """
+        Adds a link tracker and buckets it by body so keyframes can be queried per body.
+
+        Args:
+            link (LinkTracker): The link tracker to add.
+        """
+        self.links.append(link)
+        self._first_frames.append(self.frame_cnt)
+        if link.link_id == -1:
+            self._base_links.setdefault(link.body_id, []).append(link)
+        else:
+            link_ids, links = self._joint_links.setdefault(link.body_id, ([], []))
+            link_ids.append(link.link_id)
+            links.append(link)
+        self._keyframe_links = None
 
     def add_keyframe(self):
         """Adds a keyframe of the current simulation state."""
         # Ideally, call every p.stepSimulation()
-        current_state = {}
-        for link in self.links:
-            link_frame = link.get_keyframe()
-            link_frame["frame"] = self.frame_cnt
-            current_state[link.name] = link_frame
-        self.states.append(current_state)
+        if self._keyframe_links is None:
+            self._keyframe_links = [
+                link for links in self._base_links.values() for link in links
+            ] + [link for _, links in self._joint_links.values() for link in links]
+            self._link_positions = np.array(
+                [link.link_pose[0] for link in self._keyframe_links]
+            ).reshape(-1, 3)
+            self._link_orientations = np.array(
+                [link.link_pose[1] for link in self._keyframe_links]
+            ).reshape(-1, 4)
+            link_index = {id(link): i for i, link in enumerate(self.links)}
+            self._keyframe_order = np.array(
+                [link_index[id(link)] for link in self._keyframe_links], dtype=int
+            )
+
+        parent_positions = []
+        parent_orientations = []
+
+        # one pose query per body for base links
+        for body_id, links in self._base_links.items():
+            position, orientation = p.getBasePositionAndOrientation(body_id)
+            parent_positions.extend([position] * len(links))
+            parent_orientations.extend([orientation] * len(links))
+
+        # one batched link state query per body for the other links
+        for body_id, (link_ids, links) in self._joint_links.items():
+            link_states = p.getLinkStates(
+                body_id, link_ids, computeForwardKinematics=True
+            )
+            for link_state in link_states:
+                parent_positions.append(link_state[4])
+                parent_orientations.append(link_state[5])
+
+        # compose the parent poses with the local link poses in one pass
+        world_positions, world_orientations = _compose_poses(
+            np.array(parent_positions).reshape(-1, 3),
+            np.array(parent_orientations).reshape(-1, 4),
+            self._link_positions,
+            self._link_orientations,
+        )
+
+        # store the row in registration order
+        self._reserve_frame()
+        self._poses[self.frame_cnt, self._keyframe_order, :3] = world_positions
+        self._poses[self.frame_cnt, self._keyframe_order, 3:] = world_orientations
         self.frame_cnt += 1
 
+    def _reserve_frame(self):
+        """Grows the keyframe buffer to fit one more frame of every tracked link."""
+        capacity, num_links, _ = self._poses.shape
+        if self.frame_cnt < capacity and num_links == len(self.links):
+            return
+        if self.frame_cnt >= capacity:
+            capacity = max(2 * capacity, _FRAME_CHUNK)
+        poses = np.full((capacity, len(self.links), 7), np.nan, dtype=np.float32)
+        poses[: self.frame_cnt, :num_links] = self._poses[: self.frame_cnt]
+        self._poses = poses
+
     # def prompt_save(self):
     #     """Prompts the user to save the recorded simulation states."""
     #     layout = [[sg.Text('Do you want to save previous episode?')],
@@ -248,7 +411,9 @@ class PyBulletRecorder:
 
     def reset(self):
         """Resets the recorded simulation states."""
-        self.states = []
+        self.frame_cnt = 0
+        self._poses = np.empty((0, len(self.links), 7), dtype=np.float32)
+        self._first_frames = [0] * len(self.links)
 
     def get_formatted_output(self):
         """
@@ -258,21 +423,98 @@ class PyBulletRecorder:
             dict: Formatted output of the recorded simulation states.
         """
         retval = {}
+        link_frames = []
         for link in self.links:
             retval[link.name] = {
                 "type": link.type,
                 "mesh_path": link.mesh_path,
                 "mesh_scale": link.mesh_scale,
-                "frames": [
-                    state[link.name] for state in self.states if link.name in state
-                ],
+                "frames": [],
             }
-        print("[Recorder] \033[34mInfo\033[0m: Frames num {}".format(len(self.states)))
+            link_frames.append(retval[link.name]["frames"])
+
+        # single pass over the frames; links are registered in order, so the
+        # ones already recorded in a frame are a prefix of self.links
+        for frame, poses in enumerate(self._poses[: self.frame_cnt]):
+            num_links = bisect.bisect_right(self._first_frames, frame)
+            for frames, pose in zip(link_frames, poses[:num_links].tolist()):
+                frames.append(
+                    {"position": pose[:3], "orientation": pose[3:], "frame": frame}
+                )
+        print("[Recorder] \033[34mInfo\033[0m: Frames num {}".format(self.frame_cnt))
         return retval
 
+    def get_stacked_states(self):
+        """
+        Gets the recorded poses stacked into dense arrays.
+
+        Links registered after recording started are padded with NaN for the
+        frames captured before their registration.
+
+        Returns:
+            tuple: Frame numbers (F,), float32 positions (F, N, 3) and xyzw
+                orientations (F, N, 4), with links in registration order.
+        """
+        poses = self._poses[: self.frame_cnt]
+        num_links = len(self.links)
+        if poses.shape[1] != num_links:
+            # links registered after the last keyframe have no poses yet
+            poses = np.concatenate(
+                [
+                    poses,
+                    np.full(
+                        (self.frame_cnt, num_links - poses.shape[1], 7),
+                        np.nan,
+                        dtype=np.float32,
+                    ),
+                ],
+                axis=1,
+            )
+        return np.arange(self.frame_cnt), poses[..., :3], poses[..., 3:]
+
     def save(self, path):
         """
-        Saves the recorded simulation states to a file.
+        Saves the recorded simulation states to a compressed NPZ file.
+
+        The poses go into ``<path>.npz`` and the link metadata (type, mesh path
+        and scale) into a ``<path>.json`` sidecar, any extension on ``path``
+        being replaced.
+
+        Args:
+            path (str): The path to save the recorded simulation states.
+        """
+        if path is None:
+            print("[Recorder] \033[33mwarning\033[0m: Path is None.. not saving")
+            return
+
+        path = splitext(path)[0]
+        print("[Recorder] \033[34mInfo\033[0m: Saving state to {}.npz".format(path))
+        frames, positions, orientations = self.get_stacked_states()
+        np.savez_compressed(
+            path + ".npz",
+            frames=frames,
+            positions=positions,
+            orientations=orientations,
+            names=np.array([link.name for link in self.links], dtype=str),
+        )
+        metadata = {
+            link.name: {
+                "type": link.type,
+                "mesh_path": link.mesh_path,
+                "mesh_scale": (
+                    None
+                    if link.mesh_scale is None
+                    else np.asarray(link.mesh_scale).tolist()
+                ),
+            }
+            for link in self.links
+        }
+        with open(path + ".json", "w") as f:
+            json.dump(metadata, f, indent=4)
+
+    def save_pickle(self, path):
+        """
+        Saves the recorded simulation states to a pickle file (legacy format).
 
         Args:
             path (str): The path to save the recorded simulation states.
@@ -281,4 +523,5 @@ class PyBulletRecorder:
             print("[Recorder] \033[33mwarning\033[0m: Path is None.. not saving")
         else:
             print("[Recorder] \033[34mInfo\033[0m: Saving state to {}".format(path))
-            pickle.dump(self.get_formatted_output(), open(path, "wb"))
+            with open(path, "wb") as f:
+                pickle.dump(self.get_formatted_output(), f)